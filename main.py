@@ -1,18 +1,29 @@
-from flask import Flask, render_template, redirect, url_for, flash, abort
+from flask import Flask, render_template, redirect, url_for, flash, abort, request, make_response, jsonify
 from flask_sqlalchemy import SQLAlchemy
 from typing import Callable
 from flask_bootstrap import Bootstrap
 from flask_login import LoginManager, UserMixin, login_user, login_required, current_user, logout_user
 import os
+import json
+import hashlib
+import click
 from werkzeug.security import generate_password_hash, check_password_hash
+from argon2 import PasswordHasher
+from argon2.exceptions import VerifyMismatchError
 from forms import CreatePostForm, RegisterForm, LoginForm, CommentForm
-from sqlalchemy.orm import relationship
-from datetime import date
-from functools import wraps
+from sqlalchemy import select, insert, func, inspect
+from sqlalchemy.orm import relationship, selectinload, raiseload, deferred, undefer
+from datetime import date, datetime
+from functools import wraps, lru_cache
 from flask_ckeditor import CKEditor
-from flask_gravatar import Gravatar
+from flask_caching import Cache
+from psycogreen.gevent import patch_psycopg
 # unlike sqlite which is built-in in pycharm, make sure postgreSQL's package (psycopg2-binary) has been installed
 
+# gunicorn runs the app with gevent workers (see Procfile), so let psycopg2 yield to other greenlets while it waits
+# on Postgres instead of blocking the whole worker
+patch_psycopg()
+
 
 
 # make sure the Column, String, Integer ... of SQLAlchemy will not be marked yellow
@@ -22,6 +33,9 @@ class MySQLAlchemy(SQLAlchemy):
     Integer: Callable
     Text: Callable
     ForeignKey: Callable
+    Date: Callable
+    DateTime: Callable
+    Table: Callable
 
 
 # initialize the Flask app
@@ -36,41 +50,123 @@ app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get("DATABASE_URL", "sqlite:/
 # be obtained from Heroku > Setting > Config Vars; it's also specified that iff the DATABASE_URL is not provided,
 # run locally
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# size the connection pool for Heroku Postgres (hobby tiers cap at ~20 connections) and recycle connections before
+# Heroku kills them after 300s idle; sqlite doesn't use a QueuePool, so keep its defaults when running locally.
+# Every gunicorn worker (-w in the Procfile) gets its own pool, so keep workers * (pool_size + max_overflow) under the
+# cap: 2 * (5 + 3) = 16 leaves room for the release phase and `heroku run` consoles.
+# If the app is scaled to more dynos, put PgBouncer in transaction mode in front of Postgres instead of growing the pool
+if not app.config['SQLALCHEMY_DATABASE_URI'].startswith("sqlite"):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size': 5,
+        'max_overflow': 3,
+        'pool_pre_ping': True,
+        'pool_recycle': 280,
+    }
 # # configure a Secret key to use flask form using sqlite
 # app.config['SECRET_KEY'] = "kadjsfioawu39r89gjv9vz#9t8af"
 # configure a Secret Key to use flask form with postgreSQL
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY')
+# the css/js/images under /static rarely change, so let browsers keep them for a year; static_version() adds the
+# file's modification time to every url_for('static', ...) so a changed file gets a new URL
+app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 31536000
 db = MySQLAlchemy(app)
 # initialize CKEditor
 ckeditor = CKEditor(app)
 app.config['CKEDITOR_PKG_TYPE'] = 'standard-all'
+# initialize flask_caching
+cache = Cache(app, config={'CACHE_TYPE': 'SimpleCache'})
 # initialize flask_login
 login_manager = LoginManager()
 login_manager.init_app(app)
-# initialize flask_gravatar
-gravatar = Gravatar(
-    app,
-    size=100,
-    rating='g',
-    default='retro',
-    force_default=False,
-    force_lower=False,
-    use_ssl=False,
-    base_url=None
-)
+
+
+# hash passwords with argon2id; older accounts still hold werkzeug pbkdf2 hashes and are rehashed when they log in
+password_hasher = PasswordHasher(time_cost=2, memory_cost=19456, parallelism=1)
+# verified against when the email is unknown, so a missing user takes as long to reject as a wrong password. While any
+# account still holds a legacy hash, use one made the same way as those (werkzeug's pbkdf2:sha256 with 260000
+# iterations), since that is what checking a real account costs
+DUMMY_HASH = password_hasher.hash('dummy password')
+LEGACY_DUMMY_HASH = generate_password_hash('dummy password', method='pbkdf2:sha256:260000', salt_length=8)
+_legacy_hashes = {'remain': True}
+
+
+def verify_password(user, password):
+    if user.password.startswith('pbkdf2:'):
+        if not check_password_hash(user.password, password):
+            return False
+    else:
+        try:
+            password_hasher.verify(user.password, password)
+        except VerifyMismatchError:
+            return False
+        if not password_hasher.check_needs_rehash(user.password):
+            return True
+    user.password = password_hasher.hash(password)
+    db.session.commit()
+    return True
+
+
+def verify_dummy_password(password):
+    # new accounts only ever get argon2 hashes, so once the last legacy hash is upgraded there is no need to look again
+    if _legacy_hashes['remain']:
+        _legacy_hashes['remain'] = db.session.query(User.id).filter(
+            User.password.startswith('pbkdf2:')
+        ).first() is not None
+    if _legacy_hashes['remain']:
+        check_password_hash(LEGACY_DUMMY_HASH, password)
+    else:
+        try:
+            password_hasher.verify(DUMMY_HASH, password)
+        except VerifyMismatchError:
+            pass
+
+
+# today's date formatted for display, recomputed only when the day changes
+_today_cache = {'date': None, 'str': ''}
+
+
+def today_str():
+    today = date.today()
+    if _today_cache['date'] != today:
+        _today_cache.update(date=today, str=today.strftime("%B %d, %Y"))
+    return _today_cache['str']
+
+
+# files only change on deploy, which restarts the process, so each file's version is looked up once
+@lru_cache(maxsize=None)
+def static_file_version(filename):
+    return int(os.path.getmtime(os.path.join(app.static_folder, filename)))
+
+
+@app.url_defaults
+def static_version(endpoint, values):
+    if endpoint == 'static' and 'filename' in values:
+        values['v'] = static_file_version(values['filename'])
+
+
+# number of posts shown per page on the index
+POSTS_PER_PAGE = 10
 
 
 # to load a user, create a load_user function
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    return db.session.get(User, int(user_id))
+
+
+# in debug mode, make any relationship that wasn't eagerly loaded raise instead of silently firing a query per row
+def loader_options(*options):
+    if app.debug:
+        return options + (raiseload('*'),)
+    return options
 
 
 # Create admin_only decorator
 def admin_only(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if current_user.id != 1:
+        # anonymous users have no id, so they get a 403 too instead of an AttributeError
+        if getattr(current_user, 'id', None) != 1:
             return abort(403)
         else:
             return f(*args, **kwargs)
@@ -83,6 +179,8 @@ class User(UserMixin, db.Model):
     email = db.Column(db.String(250), unique=True, nullable=False)
     password = db.Column(db.String(250), nullable=False)
     name = db.Column(db.String(250), nullable=False)
+    # md5 of the email, computed once at registration for the gravatar url in post.html
+    email_hash = db.Column(db.String(32), index=True)
 
     # Parent relationship with BlogPost
     posts = relationship("BlogPost", back_populates="author")
@@ -96,6 +194,10 @@ class User(UserMixin, db.Model):
         super().__init__(*args, **kwargs)
 
 
+# emails are case-insensitive, so keep them unique regardless of case
+db.Index('ix_users_email_lower', db.func.lower(User.email), unique=True)
+
+
 class BlogPost(db.Model):
     __tablename__ = "blog_posts"
     id = db.Column(db.Integer, primary_key=True)
@@ -108,14 +210,26 @@ class BlogPost(db.Model):
 
     title = db.Column(db.String(250), unique=True, nullable=False)
     subtitle = db.Column(db.String(250), nullable=False)
-    date = db.Column(db.String(250), nullable=False)
-    body = db.Column(db.Text, nullable=False)
+    # stored as a DATE and formatted in the templates
+    date = db.Column(db.Date, nullable=False, default=date.today)
+    # the body can be large, so only load it when a view asks for it
+    body = deferred(db.Column(db.Text, nullable=False))
     img_url = db.Column(db.String(250), nullable=False)
+    # used with the post count and latest id to build the feed's ETag
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
 
     # Parent relationship with Comment
     comments = relationship("Comment", back_populates="parent_post")
 
 
+# covering index for the index feed, so postgreSQL can answer it with an index-only scan
+db.Index(
+    'ix_blog_posts_feed', BlogPost.id,
+    postgresql_include=['title', 'subtitle', 'date', 'img_url', 'author_id'],
+)
+db.Index('ix_blog_posts_date', BlogPost.date.desc())
+
+
 # CONFIGURE THE COMMENT TABLE
 class Comment(db.Model):
     __tablename__ = "comments"
@@ -132,34 +246,174 @@ class Comment(db.Model):
     text = db.Column(db.Text, nullable=False)
 
 
-if not os.path.isfile('sqlite:///blog.db'):
+# a single row recording when a post was last deleted: deleting an older post changes neither max(id) nor
+# max(updated_at), so the feed's version needs this to notice it
+class FeedState(db.Model):
+    __tablename__ = "feed_state"
+    id = db.Column(db.Integer, primary_key=True)
+    last_deleted_at = db.Column(db.DateTime)
+
+
+# insert many rows with a single executemany INSERT, skipping the ORM unit of work
+def bulk_insert(model, rows):
+    db.session.execute(insert(model), rows)
+    db.session.commit()
+
+
+# records which scripts in migrations/<dialect>/ have been applied, so each one runs once
+schema_migrations = db.Table(
+    'schema_migrations',
+    db.Column('name', db.String(255), primary_key=True),
+)
+
+
+def run_sql_script(sql):
+    connection = db.engine.raw_connection()
+    try:
+        if db.engine.dialect.name == 'sqlite':
+            # sqlite3's execute() only takes a single statement
+            connection.executescript(sql)
+        else:
+            cursor = connection.cursor()
+            cursor.execute(sql)
+            cursor.close()
+        connection.commit()
+    finally:
+        connection.close()
+
+
+# create the tables at deploy time with `flask init-db` (the Procfile runs it in the release phase); the app assumes the
+# schema already exists. create_all() never alters existing tables, so the *.sql scripts in migrations/<dialect>/ bring
+# an older database up to date. A database that create_all() builds from scratch already matches the models, so its
+# scripts are only recorded as applied
+@app.cli.command('init-db')
+def init_db():
+    fresh = not inspect(db.engine).has_table(BlogPost.__tablename__)
     db.create_all()
+    applied = {name for (name,) in db.session.execute(select(schema_migrations.c.name))}
+    migrations = os.path.join(app.root_path, 'migrations', db.engine.dialect.name)
+    names = os.listdir(migrations) if os.path.isdir(migrations) else []
+    for name in sorted(name for name in names if name.endswith('.sql')):
+        if name in applied:
+            continue
+        if not fresh:
+            with open(os.path.join(migrations, name)) as file:
+                run_sql_script(file.read())
+            click.echo(f"Applied {name}.")
+        db.session.execute(insert(schema_migrations).values(name=name))
+        db.session.commit()
+
+    # sqlite has no md5(), so fill in the gravatar hashes its scripts couldn't compute
+    for user in User.query.filter(User.email_hash.is_(None)):
+        user.email_hash = hashlib.md5(user.email.encode()).hexdigest()
+    db.session.commit()
+    click.echo("Initialized the database.")
+
+
+def get_feed_page(before):
+    # only fetch the columns the feed shows (never the body) and join the author's name in the same query
+    stmt = select(
+        BlogPost.id,
+        BlogPost.title,
+        BlogPost.subtitle,
+        BlogPost.date,
+        BlogPost.img_url,
+        User.name.label('author_name'),
+    ).outerjoin(BlogPost.author).order_by(BlogPost.id.desc())
+    # paginate by id instead of OFFSET, so older pages don't make the database scan the rows it skips
+    if before is not None:
+        stmt = stmt.where(BlogPost.id < before)
+    # fetch one extra row to know whether there is an older page
+    posts = db.session.execute(stmt.limit(POSTS_PER_PAGE + 1)).all()
+    older = posts[POSTS_PER_PAGE - 1].id if len(posts) > POSTS_PER_PAGE else None
+    return posts[:POSTS_PER_PAGE], older
+
+
+# answer with 304 Not Modified when the client already has the current version of the feed, so repeat visits cost
+# one cheap query instead of loading and rendering the posts. The version changes whenever a post is added, edited,
+# deleted or imported, from any process, and render() gets it so it can cache on it. max(id) and max(updated_at) are
+# answered from their indexes and the FeedState row by primary key, so the cost doesn't grow with the number of posts
+def feed_response(render, etag_suffix=''):
+    max_id, last_updated, last_deleted = db.session.execute(select(
+        func.max(BlogPost.id),
+        func.max(BlogPost.updated_at),
+        select(FeedState.last_deleted_at).where(FeedState.id == 1).scalar_subquery(),
+    )).one()
+    version = "-".join([
+        str(max_id),
+        str(last_updated.timestamp() if last_updated else 0),
+        str(last_deleted.timestamp() if last_deleted else 0),
+    ])
+    etag = version + etag_suffix
+    last_modified = max([moment for moment in (last_updated, last_deleted) if moment], default=None)
+    if request.if_none_match.contains(etag):
+        response = make_response('', 304)
+    else:
+        response = make_response(render(version))
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    return response
+
+
+# the index only changes when the feed version does, so cache it per version for anonymous visitors (logged-in users
+# see their own navbar and admin links); each gunicorn worker has its own cache, but keying on the version means none
+# of them can serve an old page under a new ETag
+@cache.memoize(timeout=300, unless=lambda: current_user.is_authenticated or 'before' in request.args)
+def render_index(version):
+    posts, older = get_feed_page(request.args.get('before', type=int))
+    return render_template("index.html", all_posts=posts, older=older)
 
 
 @app.route('/')
 def get_all_posts():
-    posts = BlogPost.query.all()
-    return render_template("index.html", all_posts=posts)
+    # the page also depends on who is logged in and which page is shown
+    response = feed_response(
+        render_index,
+        f"-{getattr(current_user, 'id', 0)}-{request.args.get('before', '')}",
+    )
+    response.vary.add('Cookie')
+    return response
+
+
+@app.route('/api/posts')
+def get_posts_json():
+    def render(version):
+        posts, older = get_feed_page(request.args.get('before', type=int))
+        return jsonify(
+            posts=[
+                dict(
+                    id=post.id,
+                    title=post.title,
+                    subtitle=post.subtitle,
+                    date=post.date.isoformat(),
+                    img_url=post.img_url,
+                    author=post.author_name,
+                    url=url_for('show_post', post_id=post.id, _external=True),
+                )
+                for post in posts
+            ],
+            older=older,
+        )
+    return feed_response(render, f"-{request.args.get('before', '')}")
 
 
 @app.route('/register', methods=["POST", "GET"])
 def register():
     form = RegisterForm()
     if form.validate_on_submit():
-        hash_and_salted_password = generate_password_hash(
-            password=form.password.data,
-            method='pbkdf2:sha256',
-            salt_length=8,
-        )
-        new_user = User(
-            email=form.email.data,
+        email = form.email.data.strip().lower()
+        hash_and_salted_password = password_hasher.hash(form.password.data)
+        # a single-row Core insert skips the ORM unit of work; postgreSQL hands back the new id with RETURNING
+        new_user_id = db.session.execute(insert(User).values(
+            email=email,
             password=hash_and_salted_password,
             name=form.name.data.title(),
-        )
-        db.session.add(new_user)
+            email_hash=hashlib.md5(email.encode()).hexdigest(),
+        )).inserted_primary_key[0]
         db.session.commit()
 
-        login_user(new_user)
+        login_user(db.session.get(User, new_user_id))
         return redirect(url_for('get_all_posts'))
 
     return render_template("register.html", form=form)
@@ -169,16 +423,16 @@ def register():
 def login():
     form = LoginForm()
     if form.validate_on_submit():
-        # check if user exists
-        user = User.query.filter_by(email=form.email.data).first()
-        if user:
-            if check_password_hash(user.password, form.password.data):
-                login_user(user)
-                return redirect(url_for('get_all_posts'))
-            else:
-                flash("Invalid Password! Please try again.")
-        else:
-            flash("No user found! Please try again.")
+        # check if user exists; compare on lower(email) so the lookup uses ix_users_email_lower
+        email = form.email.data.strip().lower()
+        user = User.query.filter(db.func.lower(User.email) == email).first()
+        if user and verify_password(user, form.password.data):
+            login_user(user)
+            return redirect(url_for('get_all_posts'))
+        if not user:
+            verify_dummy_password(form.password.data)
+        # don't tell apart an unknown email from a wrong password
+        flash("Invalid email or password! Please try again.")
 
     return render_template("login.html", form=form)
 
@@ -191,22 +445,29 @@ def logout():
 
 @app.route("/post/<int:post_id>", methods=["POST", "GET"])
 def show_post(post_id):
-    requested_post = BlogPost.query.get(post_id)
+    # load the comments and their authors up front so the comment loop in post.html doesn't query per comment
+    requested_post = db.session.get(BlogPost, post_id, options=loader_options(
+        undefer(BlogPost.body),
+        selectinload(BlogPost.author),
+        selectinload(BlogPost.comments).selectinload(Comment.comment_author),
+    )) or abort(404)
     comment_form = CommentForm()
 
     if comment_form.validate_on_submit():
         if current_user.is_authenticated:
-            new_comment = Comment(
+            db.session.execute(insert(Comment).values(
                 text=comment_form.comment_text.data,
-                comment_author=current_user,
-                parent_post=requested_post
-            )
-            db.session.add(new_comment)
+                author_id=current_user.id,
+                post_id=requested_post.id,
+            ))
             db.session.commit()
+            # the commit expired requested_post, and rendering it now would lazy-load its comments (which raiseload
+            # rejects in debug mode), so reload the page to fetch the new comment with the same eager loading
+            return redirect(url_for("show_post", post_id=post_id))
         else:
             flash("You need to login or register to comment.")
 
-    return render_template("post.html", post=requested_post, form=comment_form, date=date.today().strftime("%B %d, %Y"))
+    return render_template("post.html", post=requested_post, form=comment_form, date=today_str())
 
 
 @app.route("/about")
@@ -225,15 +486,13 @@ def contact():
 def add_new_post():
     form = CreatePostForm()
     if form.validate_on_submit():
-        new_post = BlogPost(
-            author=current_user,
+        db.session.execute(insert(BlogPost).values(
+            author_id=current_user.id,
             title=form.title.data,
             subtitle=form.subtitle.data,
             body=form.body.data,
             img_url=form.img_url.data,
-            date=date.today().strftime("%B %d, %Y")
-        )
-        db.session.add(new_post)
+        ))
         db.session.commit()
         return redirect(url_for("get_all_posts"))
     return render_template("make-post.html", form=form)
@@ -243,7 +502,7 @@ def add_new_post():
 @login_required
 @admin_only
 def edit_post(post_id):
-    post = BlogPost.query.get(post_id)
+    post = db.session.get(BlogPost, post_id, options=[undefer(BlogPost.body)]) or abort(404)
     edit_form = CreatePostForm(
         title=post.title,
         subtitle=post.subtitle,
@@ -267,12 +526,36 @@ def edit_post(post_id):
 @login_required
 @admin_only
 def delete_post(post_id):
-    post_to_delete = BlogPost.query.get(post_id)
+    post_to_delete = db.session.get(BlogPost, post_id) or abort(404)
     db.session.delete(post_to_delete)
+    db.session.merge(FeedState(id=1, last_deleted_at=datetime.utcnow()))
     db.session.commit()
     return redirect(url_for('get_all_posts'))
 
 
+# seed posts from a JSON list of {"title", "subtitle", "body", "img_url", "date"} objects, e.g.
+# flask import-posts posts.json --author-id 1
+@app.cli.command('import-posts')
+@click.argument('path', type=click.Path(exists=True))
+@click.option('--author-id', default=1, help="id of the user the posts are attributed to")
+def import_posts(path, author_id):
+    with open(path) as file:
+        posts = json.load(file)
+    rows = [
+        dict(
+            author_id=author_id,
+            title=post['title'],
+            subtitle=post['subtitle'],
+            body=post['body'],
+            img_url=post['img_url'],
+            date=date.fromisoformat(post['date']) if post.get('date') else date.today(),
+        )
+        for post in posts
+    ]
+    bulk_insert(BlogPost, rows)
+    click.echo(f"Imported {len(rows)} posts.")
+
+
 if __name__ == "__main__":
     app.run(host='0.0.0.0', port=5000, debug=True)
 
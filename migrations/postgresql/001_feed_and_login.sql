@@ -0,0 +1,29 @@
+-- Brings a database created before the feed/login changes up to date with the models in main.py.
+-- `flask init-db` runs it once and records it in schema_migrations; the statements are still guarded so a re-run (or a
+-- database that already has some of the changes) is harmless.
+
+-- blog_posts.date: VARCHAR holding "May 04, 2022" -> DATE
+DO $$
+BEGIN
+    IF (SELECT data_type FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = 'blog_posts' AND column_name = 'date') <> 'date' THEN
+        ALTER TABLE blog_posts ALTER COLUMN date TYPE date USING to_date(date, 'Month DD, YYYY');
+    END IF;
+END $$;
+
+-- blog_posts.updated_at, used for the feed's ETag / Last-Modified
+ALTER TABLE blog_posts ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP WITHOUT TIME ZONE;
+UPDATE blog_posts SET updated_at = date WHERE updated_at IS NULL;
+CREATE INDEX IF NOT EXISTS ix_blog_posts_updated_at ON blog_posts (updated_at);
+
+CREATE INDEX IF NOT EXISTS ix_blog_posts_feed ON blog_posts (id) INCLUDE (title, subtitle, date, img_url, author_id);
+CREATE INDEX IF NOT EXISTS ix_blog_posts_date ON blog_posts (date DESC);
+
+-- users.email: stored lowercased and unique regardless of case
+UPDATE users SET email = lower(trim(email)) WHERE email <> lower(trim(email));
+CREATE UNIQUE INDEX IF NOT EXISTS ix_users_email_lower ON users (lower(email));
+
+-- users.email_hash: md5 of the normalized email for gravatar
+ALTER TABLE users ADD COLUMN IF NOT EXISTS email_hash VARCHAR(32);
+UPDATE users SET email_hash = md5(email) WHERE email_hash IS NULL;
+CREATE INDEX IF NOT EXISTS ix_users_email_hash ON users (email_hash);
@@ -0,0 +1,46 @@
+-- Brings a sqlite database created before the feed/login changes (like the original blog.db) up to date with the models
+-- in main.py. `flask init-db` runs it once and records it in schema_migrations; the users' email_hash values are then
+-- filled in by init-db itself, since sqlite has no md5().
+BEGIN;
+
+-- blog_posts.date: VARCHAR holding "May 04, 2022" -> DATE, plus the new updated_at column. sqlite can't change a
+-- column's type in place, so rebuild the table.
+CREATE TABLE blog_posts_new (
+	id INTEGER NOT NULL,
+	author_id INTEGER,
+	title VARCHAR(250) NOT NULL,
+	subtitle VARCHAR(250) NOT NULL,
+	date DATE NOT NULL,
+	body TEXT NOT NULL,
+	img_url VARCHAR(250) NOT NULL,
+	updated_at DATETIME,
+	PRIMARY KEY (id),
+	FOREIGN KEY(author_id) REFERENCES users (id),
+	UNIQUE (title)
+);
+INSERT INTO blog_posts_new (id, author_id, title, subtitle, date, body, img_url, updated_at)
+SELECT id, author_id, title, subtitle, iso_date, body, img_url, iso_date || ' 00:00:00.000000'
+FROM (
+    SELECT *, substr(date, -4) || '-' || CASE substr(date, 1, instr(date, ' ') - 1)
+        WHEN 'January' THEN '01' WHEN 'February' THEN '02' WHEN 'March' THEN '03' WHEN 'April' THEN '04'
+        WHEN 'May' THEN '05' WHEN 'June' THEN '06' WHEN 'July' THEN '07' WHEN 'August' THEN '08'
+        WHEN 'September' THEN '09' WHEN 'October' THEN '10' WHEN 'November' THEN '11' WHEN 'December' THEN '12'
+    END || '-' || substr(date, -8, 2) AS iso_date
+    FROM blog_posts
+);
+DROP TABLE blog_posts;
+ALTER TABLE blog_posts_new RENAME TO blog_posts;
+
+CREATE INDEX ix_blog_posts_feed ON blog_posts (id);
+CREATE INDEX ix_blog_posts_date ON blog_posts (date DESC);
+CREATE INDEX ix_blog_posts_updated_at ON blog_posts (updated_at);
+
+-- users.email: stored lowercased and unique regardless of case
+UPDATE users SET email = lower(trim(email)) WHERE email <> lower(trim(email));
+CREATE UNIQUE INDEX ix_users_email_lower ON users (lower(email));
+
+-- users.email_hash: md5 of the normalized email for gravatar
+ALTER TABLE users ADD COLUMN email_hash VARCHAR(32);
+CREATE INDEX ix_users_email_hash ON users (email_hash);
+
+COMMIT;
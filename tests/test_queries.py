@@ -0,0 +1,98 @@
+import os
+
+# main reads its config at import time, so point it at an in-memory database first. Always override DATABASE_URL:
+# the fixtures drop every table, so they must never run against a real database exported in the shell
+os.environ["DATABASE_URL"] = "sqlite://"
+os.environ.setdefault("SECRET_KEY", "test")
+
+import pytest
+from sqlalchemy import event
+
+from main import app, db, cache, User, BlogPost, Comment
+
+# main may already have been imported with another database before this module set the environment
+if app.config["SQLALCHEMY_DATABASE_URI"] != "sqlite://":
+    raise RuntimeError("tests must run against the in-memory sqlite database")
+
+
+@pytest.fixture
+def client():
+    old_config = app.config.copy()
+    # DEBUG turns on raiseload('*'), so any relationship a view forgot to eager-load raises
+    app.config.update(TESTING=True, DEBUG=True, WTF_CSRF_ENABLED=False)
+    with app.app_context():
+        db.create_all()
+        author = User(email="admin@example.com", password="x", name="Admin", email_hash="0" * 32)
+        db.session.add(author)
+        for n in range(3):
+            post = BlogPost(
+                author=author,
+                title=f"Post {n}",
+                subtitle="Subtitle",
+                body="<p>Body</p>",
+                img_url="https://example.com/image.jpg",
+            )
+            db.session.add(post)
+            db.session.add(Comment(text="Nice post", comment_author=author, parent_post=post))
+        db.session.commit()
+    cache.clear()
+
+    yield app.test_client()
+
+    with app.app_context():
+        db.session.remove()
+        db.drop_all()
+    app.config.clear()
+    app.config.update(old_config)
+
+
+# record every SQL statement sent to the database while the test runs
+@pytest.fixture
+def queries(client):
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    yield statements
+    event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+
+def test_index_query_count(client, queries):
+    response = client.get("/")
+    assert response.status_code == 200
+    assert len(queries) <= 2
+
+
+def test_show_post_eager_loads_comments(client, queries):
+    response = client.get("/post/1")
+    assert response.status_code == 200
+    assert b"Nice post" in response.data
+    # the post, its author, its comments and their authors
+    assert len(queries) <= 4
+
+
+def test_comment_redirects_back_to_post(client):
+    with client.session_transaction() as session:
+        session["_user_id"] = "1"
+        session["_fresh"] = True
+    response = client.post("/post/1", data={"comment_text": "Thanks for sharing"})
+    assert response.status_code == 302
+    response = client.get("/post/1")
+    assert b"Thanks for sharing" in response.data
+
+
+def test_deleting_an_older_post_changes_the_index_etag(client):
+    etag = client.get("/").headers["ETag"]
+    with client.session_transaction() as session:
+        session["_user_id"] = "1"
+        session["_fresh"] = True
+    client.get("/delete/1")
+    with client.session_transaction() as session:
+        session.clear()
+    response = client.get("/", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag